@@ -1,21 +1,61 @@
-from fastapi import FastAPI
+import os
 
-app = FastAPI()
+import orjson
+from fastapi import FastAPI, Response
+
+# Sync (def) routes and dependencies run in anyio's threadpool, which has 40 threads by default
+# All the routes here are async, but raise the limit at startup so any def ones added later
+# don't queue up behind each other under load
+from contextlib import asynccontextmanager
+
+import anyio.to_thread
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    anyio.to_thread.current_default_thread_limiter().total_tokens = 200
+    yield
+
+
+# The docs pages and /openapi.json make the app build its whole schema
+# Turn them off in production by running with ENV=prod
+no_docs = {"docs_url": None, "redoc_url": None, "openapi_url": None}
+
+# Routes with a return type hint get their response validated and serialized
+# straight to JSON bytes by Pydantic, skipping jsonable_encoder
+app = FastAPI(
+    lifespan=lifespan,
+    **(no_docs if os.getenv("ENV") == "prod" else {}),
+)
+
+# Gzip responses bigger than 512 bytes for clients that accept it
+# Level 4 gets most of the size savings for much less CPU than the default of 9
+from fastapi.middleware.gzip import GZipMiddleware
+
+app.add_middleware(GZipMiddleware, minimum_size=512, compresslevel=4)
 
 
 # Define a route, return a message
+# The message never changes, so encode it to JSON bytes once at import time
+# Returning a Response directly skips FastAPI's jsonable_encoder pass
+root_json = orjson.dumps({"message": "Hello World"})
+
+
 @app.get("/")
 async def root():
-    return {"message": "Hello World"}
+    return Response(root_json, media_type="application/json")
 
 
 # Use Python format strings to dynamically define routes with a path parameter
 # Use type hints to correctly parse and validate path param values
 @app.get("/items/{item_id}")
-async def read_item(item_id: int):
+async def read_item(item_id: int) -> dict[str, int]:
     return {"item_id": item_id}
 
 
+user_me_json = orjson.dumps({"user_id": "the current user"})
+
+
 # FastAPI evaluates matching routes in order
 # The following two routes need to be declared in this order
 # Otherwise "me" could be mistaken for the user_id
@@ -23,11 +63,11 @@ async def read_item(item_id: int):
 # If the first one is post and the second get, you get 405 error
 @app.get("/users/me")
 async def read_user_me():
-    return {"user_id": "the current user"}
+    return Response(user_me_json, media_type="application/json")
 
 
 @app.get("/users/{user_id}")
-async def read_user(user_id: str):
+async def read_user(user_id: str) -> dict[str, str]:
     return {"user_id": user_id}
 
 
@@ -41,27 +81,42 @@ class ModelName(str, Enum):
     lenet = "lenet"
 
 
-@app.get("/models/{model_name}")
-async def get_model(model_name: ModelName):
-    # different ways to evaluate the ModelName
-    if model_name is ModelName.alexnet:
-        return {"model_name": model_name, "message": "Deep Learning FTW!"}
+# Enum members are hashable, so look up the message instead of an if chain
+model_messages = {
+    ModelName.alexnet: "Deep Learning FTW!",
+    ModelName.lenet: "LeCNN all the images",
+    ModelName.resnet: "Have some residuals",
+}
 
-    if model_name.value == "lenet":
-        return {"model_name": model_name, "message": "LeCNN all the images"}
+# There are only three possible responses, so encode each one once at import time
+model_json = {
+    model_name: orjson.dumps({"model_name": model_name, "message": message})
+    for model_name, message in model_messages.items()
+}
 
-    return {"model_name": model_name, "message": "Have some residuals"}
+
+@app.get("/models/{model_name}")
+async def get_model(model_name: ModelName):
+    return Response(model_json[model_name], media_type="application/json")
 
 
 # Evaluation query parameters
 # values for skip and limit can be defined in query params
 # e.g. /items/?skip=3&limit=1
+# The fake db never changes, so each (skip, limit) page is encoded once and cached
+from functools import lru_cache
+
 fake_items_db = [{"item_name": "Foo"}, {"item_name": "Bar"}, {"item_name": "Baz"}]
 
 
+@lru_cache(maxsize=64)
+def db_page_json(skip: int, limit: int) -> bytes:
+    return orjson.dumps(fake_items_db[skip : skip + limit])
+
+
 @app.get("/items/")
 async def read_db_item(skip: int = 0, limit: int = 10):
-    return fake_items_db[skip : skip + limit]
+    return Response(db_page_json(skip, limit), media_type="application/json")
 
 
 # Required query params have no default value
@@ -74,14 +129,17 @@ dsa = dict[str, Any]  # if we need a specify a dict key:value type
 
 
 @app.get("/detailedItems/{item_id}")
-async def read_item_detailed(item_id: str, short: bool, q: int | None = None):
-    item: dsa = {"item_id": item_id}
-    if q:
-        item.update({"q": q})
-    if not short:
-        item.update(
-            {"description": "This is an amazing product with a long description"}
-        )
+async def read_item_detailed(item_id: str, short: bool, q: int | None = None) -> dsa:
+    # Build the dict in one literal instead of growing it with update calls
+    item: dsa = {
+        "item_id": item_id,
+        **({"q": q} if q else {}),
+        **(
+            {}
+            if short
+            else {"description": "This is an amazing product with a long description"}
+        ),
+    }
     return item
 
 
@@ -102,13 +160,14 @@ class Item(BaseModel):
 
 
 @app.post("/items3/{item_id}")
-async def create_item(item_id: int, item: Item, q: int | None = None):
-    result = {"item_id": item_id, **item.dict()}
-    if item.tax:
-        price_with_tax = item.price + item.tax
-        result.update({"price_with_tax": price_with_tax})
-    if q:
-        result.update({"q": q})
+async def create_item(item_id: int, item: Item, q: int | None = None) -> dsa:
+    # model_dump is the Pydantic v2 API; .dict() is a deprecated v1 shim around it
+    result = {
+        "item_id": item_id,
+        **item.model_dump(),
+        **({"price_with_tax": item.price + item.tax} if item.tax else {}),
+        **({"q": q} if q else {}),
+    }
     return result
 
 
@@ -118,12 +177,15 @@ async def create_item(item_id: int, item: Item, q: int | None = None):
 meters = float
 Coordinates = tuple[meters, meters]
 
-from math import sqrt
+# hypot does the squares, sum, and sqrt in one C call, and avoids overflow on huge inputs
+from math import hypot
 
 
+# Cheap CPU-only handlers should be async def so they run on the event loop
+# A plain def handler gets dispatched to the threadpool, which costs more than the math
 @app.post("/distance/")
-def measure_distance(loc1: Coordinates, loc2: Coordinates) -> meters:
-    d = sqrt((loc1[0] - loc2[0]) ** 2 + (loc1[1] - loc2[1]) ** 2)
+async def measure_distance(loc1: Coordinates, loc2: Coordinates) -> meters:
+    d = hypot(loc1[0] - loc2[0], loc1[1] - loc2[1])
     return d
 
 
@@ -133,32 +195,34 @@ def measure_distance(loc1: Coordinates, loc2: Coordinates) -> meters:
 from dataclasses import dataclass
 
 
-@dataclass(frozen=True)  # immutable
+@dataclass(frozen=True, slots=True)  # immutable, no per-instance __dict__
 class Coords:
     x: meters
     y: meters
 
 
 @app.post("/distance2/")
-def measure_distance2(loc1: Coords, loc2: Coords) -> meters:
-    d = sqrt((loc1.x - loc2.x) ** 2 + (loc1.y - loc2.y) ** 2)
+async def measure_distance2(loc1: Coords, loc2: Coords) -> meters:
+    d = hypot(loc1.x - loc2.x, loc1.y - loc2.y)
     return d
 
 
 # Additional string validation of query params with Annotated and Query function
 # In this case if q is provided must be 3-50 chars and start w/ capital alpha char
 # But it could be None also
+# Use pattern (regex is the deprecated name); it's compiled once when the route is built, not per request
 from typing import Annotated
 from fastapi import Query
 
-validq = Annotated[str | None, Query(min_length=3, max_length=50, regex="^[A-Z]")]
+validq = Annotated[str | None, Query(min_length=3, max_length=50, pattern="^[A-Z]")]
 
 
 @app.get("/items4/")
-async def read_items(q: validq = None):
-    results: dsa = {"items": [{"item_id": "Foo"}, {"item_id": "Bar"}]}
-    if q:
-        results.update({"q": q})
+async def read_items(q: validq = None) -> dsa:
+    results: dsa = {
+        "items": [{"item_id": "Foo"}, {"item_id": "Bar"}],
+        **({"q": q} if q else {}),
+    }
     return results
 
 
@@ -170,23 +234,21 @@ validID = Annotated[int, Path(le=500, gt=1)]
 
 
 @app.get("/items5/{item_id}")
-async def read_items2(item_id: validID, q: str):
-    results: dsa = {"item_id": item_id}
-    if q:
-        results.update({"q": q})
+async def read_items2(item_id: validID, q: str) -> dsa:
+    results: dsa = {"item_id": item_id, **({"q": q} if q else {})}
     return results
 
 
 # Declare multiple body params
 # User is optional (default None). If provided full_name is optional
-@dataclass(frozen=True)  # immutable
+@dataclass(frozen=True, slots=True)  # immutable, no per-instance __dict__
 class User:
     username: str
     full_name: str | None = None
 
 
 @app.put("/items/{item_id}")
-async def update_item(item_id: validID, item: Item, user: User | None = None):
+async def update_item(item_id: validID, item: Item, user: User | None = None) -> dsa:
     results = {"item_id": item_id, "item": item, "user": user}
     return results
 
@@ -200,7 +262,7 @@ validImportance = Annotated[int, Body()]
 @app.put("/items6/{item_id}")
 async def update_item2(
     item_id: validID, item: Item, user: User, importance: validImportance
-):
+) -> dsa:
     results = {"item_id": item_id, "item": item, "user": user, "importance": importance}
     return results
 
@@ -210,7 +272,7 @@ validItem = Annotated[Item, Body(embed=True)]
 
 
 @app.put("/items7/{item_id}")
-async def update_item3(item_id: int, item: validItem):
+async def update_item3(item_id: int, item: validItem) -> dsa:
     results = {"item_id": item_id, "item": item}
     return results
 
@@ -240,7 +302,7 @@ validItem2 = Annotated[Item2, Body(embed=True)]
 
 
 @app.put("/items8/{item_id}")
-async def update_item4(item_id: int, item: validItem2):
+async def update_item4(item_id: int, item: validItem2) -> dsa:
     results = {"item_id": item_id, "item": item}
     return results
 
@@ -261,7 +323,7 @@ class Item3(BaseModel):
 
 
 @app.put("/items9/{item_id}")
-async def update_item5(item_id: int, item: Item3):
+async def update_item5(item_id: int, item: Item3) -> dsa:
     results = {"item_id": item_id, "item": item}
     return results
 
@@ -286,18 +348,298 @@ class Item4(BaseModel):
 
 
 @app.put("/items10/{item_id}")
-async def update_item6(item_id: int, item: Item4):
+async def update_item6(item_id: int, item: Item4) -> dsa:
     results = {"item_id": item_id, "item": item}
     return results
 
 
 # You can receive request bodies of arbitrary dicts
 # Even though JSON must have str keys
-# If the key can be cast to int, it will be
-# Kinda works, autodoc thinks the int should be a string
-# Error message indicates it needs to be an integer
-# No clear doc that it should be a string that can be cast to an int
-# I think keys other than str for arbitrary request body dicts are anti-pattern
-@app.post("/index-weights/")
-async def create_index_weights(weights: dict[int, float]):
-    return weights[1]
+# This used to be a dict[int, float] body, which cast and validated every key and value
+# Only weights[1] is used, so now only that value is validated from the raw body
+# The checks and error shapes are copied from what FastAPI does for a typed JSON body
+# That changes the contract in a few places:
+# - The key must be exactly "1", so {"01": 2} and {" 1": 2} are a 422 missing (were 200)
+# - Other keys and values are ignored, so {"1": 2, "x": 1} and {"1": 2, "2": "x"}
+#   are 200 (were 422)
+# - A missing "1" is a 422 missing (was a KeyError and a 500)
+# - An empty application/json body is a json_invalid (was a body-level missing)
+# - A body starting with a UTF-8 BOM is a 422 json_invalid (was 200)
+# - The ctx.error text for invalid JSON comes from orjson instead of the json module
+# openapi_extra keeps the body documented since it's no longer a typed param
+import email.message
+
+from fastapi import Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import TypeAdapter, ValidationError
+
+weights_body = {
+    "content": {
+        "application/json": {
+            "schema": {
+                "type": "object",
+                "additionalProperties": {"type": "number"},
+                "title": "Weights",
+            }
+        }
+    },
+    "required": True,
+}
+
+# Without typed params FastAPI doesn't document the 422 response, so add it back too
+weights_responses = {
+    "422": {
+        "description": "Validation Error",
+        "content": {
+            "application/json": {
+                "schema": {"$ref": "#/components/schemas/HTTPValidationError"}
+            }
+        },
+    }
+}
+
+# Same lax float parsing as the dict[int, float] values, so "2.5" and true still work
+weight_adapter = TypeAdapter(float)
+
+
+def body_error(
+    error_type: str, loc: tuple[str | int, ...], msg: str, input: Any, **extra: Any
+) -> RequestValidationError:
+    return RequestValidationError(
+        [
+            {
+                "type": error_type,
+                "loc": ("body", *loc),
+                "msg": msg,
+                "input": input,
+                **extra,
+            }
+        ]
+    )
+
+
+def is_json(content_type: str | None) -> bool:
+    if not content_type:
+        return False
+    message = email.message.Message()
+    message["content-type"] = content_type
+    subtype = message.get_content_subtype()
+    return message.get_content_maintype() == "application" and (
+        subtype == "json" or subtype.endswith("+json")
+    )
+
+
+@app.post(
+    "/index-weights/",
+    openapi_extra={"requestBody": weights_body, "responses": weights_responses},
+)
+async def create_index_weights(request: Request) -> float:
+    body = await request.body()
+    if not is_json(request.headers.get("content-type")):
+        raise body_error(
+            "dict_type", (), "Input should be a valid dictionary", body.decode()
+        )
+    try:
+        weights = orjson.loads(body)
+    except orjson.JSONDecodeError as exc:
+        raise body_error(
+            "json_invalid", (exc.pos,), "JSON decode error", {}, ctx={"error": exc.msg}
+        ) from exc
+    if not isinstance(weights, dict):
+        raise body_error("dict_type", (), "Input should be a valid dictionary", weights)
+    if "1" not in weights:
+        raise body_error("missing", ("1",), "Field required", weights)
+    try:
+        return weight_adapter.validate_python(weights["1"])
+    except ValidationError as exc:
+        error = exc.errors(include_url=False)[0]
+        raise body_error(error["type"], ("1",), error["msg"], error["input"]) from exc
+
+
+# Starlette's router tries every route's regex in order until one matches
+# Paths without params can be found with a dict lookup on (method, path) instead
+# Paths with params are matched against one combined regex per method
+# The named group that matched tells us which route won, in the same order as the router
+# This is an ASGI middleware on the router itself, so exception handlers still apply
+# The lookup tables are rebuilt when routes are added or removed, e.g. after import
+# test_main.py checks that it picks the same route as the router for every route here
+import re
+
+from starlette.routing import Match, Route, Router
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+try:
+    # FastAPI's router reports the matched route to its telemetry (http.route, span name)
+    from fastapi.routing import _route_selected as route_selected
+except ImportError:  # FastAPI versions without telemetry
+
+    def route_selected(**kwargs: Any) -> None:
+        pass
+
+
+class RouteLookupMiddleware:
+    def __init__(self, app: ASGIApp, router: Router) -> None:
+        self.app = app
+        self.router = router
+        self.build()
+
+    def build(self) -> None:
+        # Remember what the tables were built from, so lookup can tell when they're stale
+        self.built_routes = self.router.routes
+        self.built_count = len(self.router.routes)
+        self.static_routes: dict[tuple[str, str], tuple[Route, Scope]] = {}
+        dynamic_routes: dict[str, list[Route]] = {}
+        for route in self.router.routes:
+            # Anything that is not a plain route (e.g. a Mount) can claim arbitrary paths
+            # Routes after it are left to the router so the order is preserved
+            # Newer FastAPI versions keep an included APIRouter as one opaque entry too,
+            # which is why the routes here are declared on the app instead of on routers
+            # A route without methods (a raw ASGI endpoint) matches every method
+            if not isinstance(route, Route) or route.methods is None:
+                break
+            for method in route.methods:
+                if route.param_convertors:
+                    dynamic_routes.setdefault(method, []).append(route)
+                    continue
+                probe: Scope = {
+                    "type": "http",
+                    "method": method,
+                    "path": route.path,
+                    "root_path": "",
+                    "headers": [],
+                }
+                # Keep first-match-wins: skip paths an earlier route would claim
+                winner = self.first_full_match(probe)
+                if winner is not None and winner[0] is route:
+                    self.static_routes[(method, route.path)] = winner
+        self.dynamic_routes: dict[str, tuple[re.Pattern[str], dict[str, Route]]] = {}
+        for method, routes in dynamic_routes.items():
+            named_routes = {f"route{i}": route for i, route in enumerate(routes)}
+            self.dynamic_routes[method] = (
+                self.combine_regexes(named_routes),
+                named_routes,
+            )
+
+    def first_full_match(self, scope: Scope) -> tuple[Route, Scope] | None:
+        for route in self.router.routes:
+            match, child_scope = route.matches(scope)
+            if match == Match.FULL:
+                return route, child_scope
+        return None
+
+    @staticmethod
+    def combine_regexes(named_routes: dict[str, Route]) -> re.Pattern[str]:
+        # Each route's params are named groups, and names can't repeat in one regex
+        # They're made non-capturing here since the winning route parses its own params
+        branches = (
+            f"(?P<{name}>"
+            + re.sub(r"\(\?P<\w+>", "(?:", route.path_regex.pattern[1:-1])
+            + ")"
+            for name, route in named_routes.items()
+        )
+        return re.compile("^(?:" + "|".join(branches) + ")$")
+
+    def lookup(self, scope: Scope) -> tuple[Route, Scope] | None:
+        routes = self.router.routes
+        if routes is not self.built_routes or len(routes) != self.built_count:
+            self.build()
+        method = scope["method"]
+        path = scope["path"]
+        root_path = scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path) :]
+        static = self.static_routes.get((method, path))
+        if static is not None:
+            route, child_scope = static
+            return route, {**child_scope, "path_params": {}}
+        if method in self.dynamic_routes:
+            regex, named_routes = self.dynamic_routes[method]
+            found = regex.match(path)
+            if found is not None:
+                route = named_routes[found.lastgroup]
+                match, child_scope = route.matches(scope)
+                if match == Match.FULL:
+                    return route, child_scope
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http":
+            found = self.lookup(scope)
+            if found is not None:
+                route, child_scope = found
+                scope.setdefault("router", self.router)
+                scope.update(child_scope)
+                route_selected(scope=scope, path=route.path_format)
+                await route.handle(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+app.router.middleware_stack = RouteLookupMiddleware(
+    app.router.middleware_stack, app.router
+)
+
+
+# Generate the OpenAPI schema at import instead of on the first /docs or /openapi.json hit
+# FastAPI keeps it in app.openapi_schema and reuses it from then on
+# Set OPENAPI_SCHEMA_PATH to save the schema to disk and load it from there on later starts
+# e.g. generate it while building a production image
+# The saved copy is keyed on this file and the FastAPI/Pydantic versions, so it's rebuilt when they change
+# Skipped when the docs are turned off, since nothing serves the schema then
+import hashlib
+import logging
+
+import fastapi
+import pydantic
+
+# uvicorn's logger, so the message shows up in the server output
+logger = logging.getLogger("uvicorn.error")
+
+
+def openapi_cache_key() -> str:
+    with open(__file__, "rb") as f:
+        source = f.read()
+    versions = f"{fastapi.__version__} {pydantic.VERSION}".encode()
+    return hashlib.sha256(source + versions).hexdigest()
+
+
+def load_openapi_schema(path: str, key: str) -> dict[str, Any] | None:
+    try:
+        with open(path, "rb") as f:
+            cached = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+    if not isinstance(cached, dict) or cached.get("key") != key:
+        return None
+    return cached["schema"]
+
+
+def save_openapi_schema(path: str, key: str, schema: dict[str, Any]) -> None:
+    # Write to a temp file and rename it into place, so other workers starting at the
+    # same time see either the old file or the whole new one, never a partial write
+    # The cache is optional, so a path that can't be written only costs the speedup
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps({"key": key, "schema": schema}))
+        os.replace(tmp_path, path)
+    except OSError as exc:
+        logger.warning("Could not cache OpenAPI schema to %s: %s", path, exc)
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+openapi_schema_path = os.getenv("OPENAPI_SCHEMA_PATH")
+if app.openapi_url is not None:
+    if openapi_schema_path:
+        key = openapi_cache_key()
+        app.openapi_schema = load_openapi_schema(openapi_schema_path, key)
+        if app.openapi_schema is not None:
+            logger.info("Loaded OpenAPI schema from %s", openapi_schema_path)
+        else:
+            # app.openapi() keeps the schema on the app even if saving it fails
+            save_openapi_schema(openapi_schema_path, key, app.openapi())
+    else:
+        app.openapi()
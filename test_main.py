@@ -0,0 +1,187 @@
+import re
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.responses import PlainTextResponse
+from starlette.routing import Match, Mount, Route, Router
+from starlette.types import Scope
+
+import main
+from main import RouteLookupMiddleware, app
+
+
+def http_scope(method: str, path: str) -> Scope:
+    return {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "root_path": "",
+        "headers": [],
+        "query_string": b"",
+    }
+
+
+def linear_scan(router: Router, scope: Scope) -> Route | None:
+    for route in router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route
+    return None
+
+
+def fast_path(middleware: RouteLookupMiddleware, scope: Scope) -> Route | None:
+    found = middleware.lookup(scope)
+    return found[0] if found is not None else None
+
+
+def declared_scopes() -> list[Scope]:
+    scopes = []
+    for route in app.routes:
+        # Fill every path param with a value its regex accepts
+        path = re.sub(r"{[^}]+}", "3", route.path_format)
+        for method in route.methods:
+            scopes.append(http_scope(method, path))
+    return scopes
+
+
+@pytest.mark.parametrize(
+    "scope", declared_scopes(), ids=lambda s: f"{s['method']} {s['path']}"
+)
+def test_fast_path_matches_linear_scan(scope: Scope):
+    route = fast_path(app.router.middleware_stack, scope)
+    assert route is not None
+    assert route is linear_scan(app.router, scope)
+
+
+def test_users_me_is_not_shadowed_by_user_id():
+    scope = http_scope("GET", "/users/me")
+    assert fast_path(app.router.middleware_stack, scope).endpoint is main.read_user_me
+    scope = http_scope("GET", "/users/bob")
+    assert fast_path(app.router.middleware_stack, scope).endpoint is main.read_user
+
+
+@pytest.mark.parametrize(
+    "method, path",
+    [("GET", "/nope"), ("DELETE", "/items/3"), ("POST", "/"), ("GET", "/items")],
+)
+def test_unmatched_requests_fall_back_to_router(method: str, path: str):
+    assert fast_path(app.router.middleware_stack, http_scope(method, path)) is None
+
+
+async def endpoint(request):
+    return PlainTextResponse("ok")
+
+
+class RawASGIApp:
+    async def __call__(self, scope, receive, send):
+        await PlainTextResponse("raw")(scope, receive, send)
+
+
+raw_asgi = RawASGIApp()
+
+
+@pytest.mark.parametrize(
+    "barrier",
+    [Mount("/b", app=raw_asgi), Route("/b/{x}", endpoint=raw_asgi)],
+    ids=["mount", "methodless route"],
+)
+def test_routes_after_a_barrier_are_left_to_router(barrier):
+    router = Router(
+        routes=[
+            Route("/a/{x}", endpoint=endpoint),
+            barrier,
+            Route("/b/{x}", endpoint=endpoint),
+            Route("/c", endpoint=endpoint),
+        ]
+    )
+    middleware = RouteLookupMiddleware(router.middleware_stack, router)
+    scope = http_scope("GET", "/a/3")
+    assert fast_path(middleware, scope) is linear_scan(router, scope)
+    # The barrier claims /b/3 first, so the later route must not win on the fast path
+    assert linear_scan(router, http_scope("GET", "/b/3")) is barrier
+    assert fast_path(middleware, http_scope("GET", "/b/3")) is None
+    assert fast_path(middleware, http_scope("GET", "/c")) is None
+
+
+def test_routes_added_after_install_are_picked_up():
+    router = Router(routes=[Route("/a/{x}", endpoint=endpoint)])
+    middleware = RouteLookupMiddleware(router.middleware_stack, router)
+    assert fast_path(middleware, http_scope("GET", "/c/3")) is None
+    router.add_route("/c", endpoint=endpoint)
+    router.add_route("/c/{x}", endpoint=endpoint)
+    for path in ["/c", "/c/3"]:
+        scope = http_scope("GET", path)
+        assert fast_path(middleware, scope) is not None
+        assert fast_path(middleware, scope) is linear_scan(router, scope)
+
+
+def test_fast_path_reports_route_to_telemetry(monkeypatch):
+    selected = []
+    monkeypatch.setattr(
+        main, "route_selected", lambda **kwargs: selected.append(kwargs["path"])
+    )
+    client = TestClient(app)
+    assert client.get("/users/bob").json() == {"user_id": "bob"}
+    assert client.get("/users/me").json() == {"user_id": "the current user"}
+    assert selected == ["/users/{user_id}", "/users/me"]
+
+
+def post_weights(content: bytes, content_type: str = "application/json"):
+    client = TestClient(app)
+    return client.post(
+        "/index-weights/", content=content, headers={"content-type": content_type}
+    )
+
+
+@pytest.mark.parametrize(
+    "content, expected",
+    [(b'{"1": 2.5, "2": 3}', 2.5), (b'{"1": "2.5"}', 2.5), (b'{"1": true}', 1.0)],
+)
+def test_index_weights_parses_weight_one_laxly(content: bytes, expected: float):
+    response = post_weights(content)
+    assert response.status_code == 200
+    assert response.json() == expected
+
+
+@pytest.mark.parametrize(
+    "content, content_type, error_type, loc",
+    [
+        (b'{"1": 2}', "text/plain", "dict_type", ["body"]),
+        (b"{", "application/json", "json_invalid", ["body", 1]),
+        (b"[1]", "application/json", "dict_type", ["body"]),
+        (b'{"2": 3}', "application/json", "missing", ["body", "1"]),
+        (b'{"1": "x"}', "application/json", "float_parsing", ["body", "1"]),
+    ],
+    ids=["content type", "invalid json", "not a dict", "missing key", "bad value"],
+)
+def test_index_weights_errors(
+    content: bytes, content_type: str, error_type: str, loc: list
+):
+    response = post_weights(content, content_type)
+    assert response.status_code == 422
+    [error] = response.json()["detail"]
+    assert error["type"] == error_type
+    assert error["loc"] == loc
+
+
+def test_index_weights_accepts_json_suffix_content_types():
+    response = post_weights(b'{"1": 2}', "application/vnd.x+json; charset=utf-8")
+    assert response.status_code == 200
+    assert response.json() == 2.0
+
+
+def test_openapi_schema_cache_round_trip(tmp_path):
+    path = str(tmp_path / "openapi.json")
+    schema = {"openapi": "3.1.0", "paths": {}}
+    main.save_openapi_schema(path, "key", schema)
+    assert main.load_openapi_schema(path, "key") == schema
+    # A cache written for other source or library versions is ignored
+    assert main.load_openapi_schema(path, "stale") is None
+    assert [p.name for p in tmp_path.iterdir()] == ["openapi.json"]
+
+
+def test_openapi_schema_cache_unwritable_path_is_skipped(tmp_path, caplog):
+    path = str(tmp_path / "missing" / "openapi.json")
+    main.save_openapi_schema(path, "key", {"openapi": "3.1.0"})
+    assert main.load_openapi_schema(path, "key") is None
+    assert "Could not cache OpenAPI schema" in caplog.text